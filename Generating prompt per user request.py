@@ -1,53 +1,464 @@
-from autogen import AssistantAgent, UserProxyAgent
+# Performance note: this module is latency-bound on Azure OpenAI network round-trips, not on CPU.
+# The optimizations that pay off here are: response caching (exact and semantic), provider-side
+# prompt caching (static prefixes first; only for prompts of 1024+ tokens), async concurrency
+# with proactive rate limiting, and fallback routing across endpoints. CPU-level techniques
+# (SIMD, Numba, Cython, CUDA, C extensions) do not apply: there are no numeric inner loops.
+from openai import AsyncAzureOpenAI, AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field, replace
+from typing import Optional
+import diskcache
+import numpy as np
+import tiktoken
 import os
 from dotenv import load_dotenv
+import asyncio
+import functools
 import time
+import json
+import hashlib
+import uuid
+import weakref
 
-# Load environment variables from .env file
-load_dotenv()
+# Environment variables are read lazily, on first use, so importing this module does not touch
+# the .env file or build any API clients.
+@functools.cache
+def get_azure_config():
+    """Load environment variables from .env and return the Azure OpenAI configuration."""
+    load_dotenv()
+    return {
+        "model": os.getenv("AZURE_model_DEPLOYMENT_NAME"),
+        "base_url": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+        "api_version": os.getenv("AZURE_OPENAI_API_VERSION")
+    }
+
+# Async clients keep an httpx connection pool tied to the event loop that first used it, so
+# clients (and the router holding them) are shared per running loop, not per process.
+# Callers that run asyncio.run() once per query then never reuse a pool from a closed loop.
+clients_by_loop = weakref.WeakKeyDictionary()
+routers_by_loop = weakref.WeakKeyDictionary()
+
+def get_client():
+    """Return the client for the primary Azure OpenAI deployment on the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in clients_by_loop:
+        clients_by_loop[loop] = create_client()
+    return clients_by_loop[loop]
+
+def create_client():
+    """Create a client for the primary Azure OpenAI deployment."""
+    azure_config = get_azure_config()
+    # The SDK's own retries would wait out 429s on this endpoint before RoutedClient could
+    # move the request elsewhere, so they are disabled for every client. RoutedClient and
+    # retry_with_backoff handle 429s, connection errors, timeouts and 5xx responses instead.
+    return AsyncAzureOpenAI(
+        azure_endpoint=azure_config["base_url"],
+        api_key=azure_config["api_key"],
+        api_version=azure_config["api_version"],
+        max_retries=0
+    )
+
+# Rough number of completion tokens charged against the TPM quota for requests without max_tokens
+COMPLETION_TOKEN_ESTIMATE = 800
 
-# Azure OpenAI configuration
-azure_config = {
-    "model": os.getenv("AZURE_model_DEPLOYMENT_NAME"),
-    "api_type": "azure",
-    "base_url": os.getenv("AZURE_OPENAI_ENDPOINT"),
-    "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
-    "api_version": os.getenv("AZURE_OPENAI_API_VERSION")
-}
+def get_retry_after(error):
+    """Return the delay in seconds requested by the server's Retry-After header, if any."""
+    if not isinstance(error, APIStatusError):
+        return None
+    response = error.response
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def is_rate_limit_error(error):
+    """Check whether an API error is a 429 rate-limit response."""
+    if isinstance(error, RateLimitError):
+        return True
+    # Some Azure errors arrive as a generic status error
+    return isinstance(error, APIStatusError) and error.status_code == 429
 
-def retry_with_backoff(func, max_retries=5, initial_delay=1):
+def is_transient_error(error):
+    """Check whether an API error is a connection problem, timeout or 5xx that is worth retrying."""
+    # APITimeoutError is a subclass of APIConnectionError
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+async def retry_with_backoff(func, max_retries=5, initial_delay=1):
     """
-    Retry a function with exponential backoff.
+    Retry an async function with exponential backoff on rate limits and transient errors.
+    Waits for the server's Retry-After delay instead when one is given.
     """
     delay = initial_delay
     for retry in range(max_retries):
         try:
-            return func()
+            return await func()
         except Exception as e:
-            if "429" in str(e) and retry < max_retries - 1:
-                print(f"\nRate limit hit. Waiting {delay} seconds before retry...")
-                time.sleep(delay)
+            if (is_rate_limit_error(e) or is_transient_error(e)) and retry < max_retries - 1:
+                wait = get_retry_after(e) or delay
+                reason = "Rate limit hit" if is_rate_limit_error(e) else f"Transient API error ({type(e).__name__})"
+                print(f"\n{reason}. Waiting {wait} seconds before retry...")
+                await asyncio.sleep(wait)
                 delay *= 2  # Exponential backoff
                 continue
             raise e
 
-def get_last_assistant_message(messages):
-    """Helper function to get the last assistant message from a conversation."""
-    for message in reversed(messages):
-        if message["role"] == "assistant":
-            return message["content"]
-    return None
+class TokenBucket:
+    """
+    Async token bucket holding up to `capacity` units that refill evenly over `period` seconds.
+    acquire() waits until enough units are available, so callers stay under the quota
+    instead of hitting it and backing off.
+    """
+    def __init__(self, capacity, period=60):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._level = capacity
+        self._updated = time.monotonic()
 
-# Create prompt generator agent
-# Note: This agent only generates prompt templates. It does NOT execute, validate, or run any queries
-# (such as SOQL queries). You will need to add your own examples and validation later.
-prompt_generator = AssistantAgent(
-    name="PromptGenerator",
-    llm_config={
-        "temperature": 0.7,
-        "config_list": [azure_config]
-    },
-    system_message="""You are an expert prompt engineer. Your role is to generate clear, effective prompts based on user queries.
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self._level >= amount:
+                self._level -= amount
+                return
+            await asyncio.sleep((amount - self._level) / self.rate)
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for a model, looked up once per model."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Azure deployment names are arbitrary; fall back to the gpt-4o encoding
+        return tiktoken.get_encoding("o200k_base")
+
+@functools.lru_cache(maxsize=None)
+def count_system_tokens(system_message, model):
+    """Token count of a static system message, computed once per message and model."""
+    return len(get_encoding(model).encode(system_message))
+
+def estimate_tokens(messages, model, max_tokens=None):
+    """Estimate the tokens a chat request will be charged against the TPM quota."""
+    encoding = get_encoding(model)
+    prompt_tokens = 0
+    for message in messages:
+        if message["role"] == "system":
+            prompt_tokens += count_system_tokens(message["content"], model)
+        else:
+            prompt_tokens += len(encoding.encode(message["content"]))
+    return prompt_tokens + (max_tokens or COMPLETION_TOKEN_ESTIMATE)
+
+@functools.cache
+def get_token_bucket(route_name, kind, capacity):
+    """Return the process-wide token bucket for one quota of one endpoint."""
+    return TokenBucket(capacity)
+
+class Route:
+    """
+    One chat endpoint together with its quota and health state.
+    """
+    # Seconds to stay away from an endpoint after a 429 that came without Retry-After
+    DEFAULT_COOLDOWN = 10
+    # Window in which recent 429s count against an endpoint when picking one
+    RATE_LIMIT_WINDOW = 60
+
+    def __init__(self, name, client, model, rpm=None, tpm=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        # Quotas hold across event loops, so the buckets are shared by every Route for this endpoint
+        self.request_limiter = get_token_bucket(name, "rpm", rpm) if rpm else None
+        self.token_limiter = get_token_bucket(name, "tpm", tpm) if tpm else None
+        self.in_flight = 0
+        self.cooling_until = 0.0
+        self.rate_limited_at = deque()
+
+    def load(self):
+        """Estimated queue depth: requests in flight plus 429s seen in the last minute."""
+        cutoff = time.monotonic() - self.RATE_LIMIT_WINDOW
+        while self.rate_limited_at and self.rate_limited_at[0] < cutoff:
+            self.rate_limited_at.popleft()
+        return self.in_flight + len(self.rate_limited_at)
+
+    def mark_rate_limited(self, retry_after=None):
+        now = time.monotonic()
+        self.rate_limited_at.append(now)
+        self.cooling_until = now + (retry_after or self.DEFAULT_COOLDOWN)
+
+    async def chat(self, messages, temperature, stop=(), max_tokens=None):
+        """
+        Stream a chat completion and return (reply text, truncated).
+        The reply is cut off as soon as one of the stop markers appears; truncated is True
+        when the model stopped because it ran into max_tokens.
+        """
+        if self.request_limiter is not None:
+            await self.request_limiter.acquire()
+        if self.token_limiter is not None:
+            await self.token_limiter.acquire(estimate_tokens(messages, self.model, max_tokens))
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=temperature,
+            stop=list(stop) or None,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        reply = ""
+        finish_reason = None
+        overlap = max((len(marker) - 1 for marker in stop), default=0)
+        async for chunk in stream:
+            # Azure sends content-filter chunks without choices
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            content = chunk.choices[0].delta.content
+            if not content:
+                continue
+            # Only scan the new text plus enough of the old buffer to catch a marker split
+            # across chunks, so the check stays linear in the reply length
+            scan_from = max(0, len(reply) - overlap)
+            reply += content
+            marker = next((marker for marker in stop if marker in reply[scan_from:]), None)
+            if marker is not None:
+                # The deployment did not honour the stop sequence; stop reading ourselves
+                await stream.close()
+                reply = reply[:reply.index(marker, scan_from)]
+                break
+        return reply.strip() or None, finish_reason == "length"
+
+class RoutedClient:
+    """
+    Spread chat requests over several endpoints. Each request goes to the healthy endpoint
+    with the lowest load; on a 429 that endpoint cools down and the request moves on to the
+    next one instead of sleeping. Connection errors, timeouts and 5xx responses also move the
+    request on, without a cooldown.
+    """
+    def __init__(self, routes):
+        self.routes = routes
+
+    def pick_route(self, exclude):
+        candidates = [route for route in self.routes if route not in exclude]
+        now = time.monotonic()
+        healthy = [route for route in candidates if route.cooling_until <= now]
+        if healthy:
+            return min(healthy, key=lambda route: route.load())
+        # Everything is cooling down; use whichever endpoint recovers first
+        return min(candidates, key=lambda route: route.cooling_until)
+
+    async def chat(self, messages, temperature, stop=(), max_tokens=None):
+        tried = []
+        last_error = None
+        for _ in self.routes:
+            route = self.pick_route(tried)
+            tried.append(route)
+            wait = route.cooling_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            route.in_flight += 1
+            try:
+                return await route.chat(messages, temperature, stop, max_tokens)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    route.mark_rate_limited(get_retry_after(e))
+                    print(f"\nRate limit hit on {route.name}.")
+                elif is_transient_error(e):
+                    print(f"\nTransient API error on {route.name} ({type(e).__name__}).")
+                else:
+                    raise e
+                last_error = e
+            finally:
+                route.in_flight -= 1
+        raise last_error
+
+def build_routes():
+    """Primary Azure deployment first, then any configured overflow endpoints."""
+    azure_config = get_azure_config()
+    # Deployment quota, used to throttle requests before Azure starts returning 429s.
+    # Leave unset to disable proactive rate limiting.
+    requests_per_minute = os.getenv("AZURE_OPENAI_RPM")
+    tokens_per_minute = os.getenv("AZURE_OPENAI_TPM")
+    rpm = int(requests_per_minute) if requests_per_minute else None
+    tpm = int(tokens_per_minute) if tokens_per_minute else None
+    routes = [Route("azure-primary", get_client(), azure_config["model"], rpm, tpm)]
+
+    # Optional overflow endpoints, used while the primary deployment is rate limited
+    secondary_azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT_2")
+    openai_fallback_api_key = os.getenv("OPENAI_API_KEY_FALLBACK")
+    if secondary_azure_endpoint:
+        secondary_client = AsyncAzureOpenAI(
+            azure_endpoint=secondary_azure_endpoint,
+            api_key=os.getenv("AZURE_OPENAI_API_KEY_2") or azure_config["api_key"],
+            api_version=azure_config["api_version"],
+            max_retries=0
+        )
+        secondary_model = os.getenv("AZURE_model_DEPLOYMENT_NAME_2") or azure_config["model"]
+        # Quotas are per deployment; fall back to the primary's values when not given
+        secondary_rpm = os.getenv("AZURE_OPENAI_RPM_2")
+        secondary_tpm = os.getenv("AZURE_OPENAI_TPM_2")
+        routes.append(Route(
+            "azure-secondary",
+            secondary_client,
+            secondary_model,
+            int(secondary_rpm) if secondary_rpm else rpm,
+            int(secondary_tpm) if secondary_tpm else tpm
+        ))
+    if openai_fallback_api_key:
+        fallback_client = AsyncOpenAI(api_key=openai_fallback_api_key, max_retries=0)
+        fallback_model = os.getenv("OPENAI_FALLBACK_MODEL", "gpt-4o")
+        routes.append(Route("openai-fallback", fallback_client, fallback_model))
+    return routes
+
+def get_router():
+    """Return the router over all configured chat endpoints for the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in routers_by_loop:
+        routers_by_loop[loop] = RoutedClient(build_routes())
+    return routers_by_loop[loop]
+
+# Both caches are stored on disk so results survive restarts of the script
+CACHE_DIR = os.path.expanduser("~/.cache/prompt-gen")
+
+class LLMCache:
+    """
+    Exact-match cache for complete generate_and_refine_prompt outputs, stored on disk.
+    Entries expire after `ttl` seconds.
+    """
+    def __init__(self, directory, default_ttl=86400, size_limit=1 << 30):
+        self.default_ttl = default_ttl
+        self._store = diskcache.Cache(directory, size_limit=size_limit)
+
+    def get(self, key):
+        return self._store.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._store.set(key, value, expire=ttl or self.default_ttl)
+
+    def clear(self):
+        self._store.clear()
+
+@functools.cache
+def get_response_cache():
+    """Return the shared exact-match cache."""
+    return LLMCache(os.path.join(CACHE_DIR, "responses"))
+
+class SemanticCache:
+    """
+    Cache that matches near-duplicate queries ("Write a prompt for X" vs "Generate a prompt for X")
+    by cosine similarity of their embeddings.
+    Every entry is its own diskcache item with an expiry, so processes sharing the cache
+    directory add to the same index instead of overwriting each other's.
+    """
+    def __init__(self, deployment, directory, threshold=0.92, ttl=3600):
+        self.deployment = deployment
+        self.threshold = threshold
+        self.ttl = ttl
+        self._disk = diskcache.Cache(directory)
+        # Vectors from different embedding deployments are not comparable, so entry keys
+        # are tagged with the deployment: (tag, entry id)
+        self._tag = f"index:{deployment}"
+        # Entries saved as a single blob under the bare tag before fingerprints existed
+        self._disk.delete(self._tag)
+        # entry key -> (vector, query, fingerprint, output, expires_at)
+        self._entries = {}
+
+    def _refresh(self):
+        """Drop expired entries and pick up entries written by other processes."""
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if entry[4] <= now]:
+            del self._entries[key]
+        for key in self._disk.iterkeys():
+            if key in self._entries or not (isinstance(key, tuple) and key[0] == self._tag):
+                continue
+            entry = self._disk.get(key)  # None once expired
+            if entry is not None:
+                self._entries[key] = entry
+
+    async def embed(self, text):
+        response = await get_client().embeddings.create(model=self.deployment, input=text)
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get(self, vector, fingerprint):
+        """
+        Return the output stored for the most similar query, considering only entries
+        produced under the same settings fingerprint (see make_cache_fingerprint).
+        """
+        self._refresh()
+        candidates = [entry for entry in self._entries.values() if entry[2] == fingerprint]
+        if not candidates:
+            return None
+        scores = np.stack([entry[0] for entry in candidates]) @ vector
+        best = int(np.argmax(scores))
+        if scores[best] > self.threshold:
+            return candidates[best][3]
+        return None
+
+    def add(self, vector, query, fingerprint, output):
+        # Remove expired items from disk and memory before adding a new one
+        self._disk.expire()
+        self._refresh()
+        key = (self._tag, uuid.uuid4().hex)
+        entry = (vector, query, fingerprint, output, time.time() + self.ttl)
+        self._disk.set(key, entry, expire=self.ttl)
+        self._entries[key] = entry
+
+    def clear(self):
+        for key in list(self._disk.iterkeys()):
+            if isinstance(key, tuple) and key[0] == self._tag:
+                self._disk.delete(key)
+        self._entries = {}
+
+@functools.cache
+def get_semantic_cache():
+    """
+    Return the shared semantic cache, or None when no embedding deployment is configured
+    (AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME).
+    """
+    get_azure_config()  # make sure .env has been loaded
+    embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME")
+    if not embedding_deployment:
+        return None
+    return SemanticCache(
+        embedding_deployment,
+        os.path.join(CACHE_DIR, "semantic"),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        ttl=int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    )
+
+def make_cache_fingerprint(num_drafts=1, deterministic=False):
+    """Hash every setting apart from the query itself that determines the agents' output."""
+    payload = {
+        "drafts": num_drafts,
+        "deterministic": deterministic,
+        # Whole agent settings, so changes to temperature or max_tokens invalidate old entries
+        "generator": asdict(prompt_generator),
+        "critic": asdict(prompt_critic),
+        "model": get_azure_config()["model"],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def make_cache_key(user_query, fingerprint):
+    """Build the exact-match cache key for a query under the given settings fingerprint."""
+    return hashlib.sha256(json.dumps({"q": user_query, "settings": fingerprint}).encode()).hexdigest()
+
+# System messages are kept as module constants so every call sends a byte-identical prefix.
+# Azure OpenAI only caches prompt prefixes for prompts of at least 1024 tokens, and both
+# messages below are far shorter, so as written this gives no caching benefit. Keep the static
+# content first and the dynamic user_query / current_prompt last anyway, so that longer system
+# messages (e.g. with added examples) become cacheable without restructuring the requests.
+GENERATOR_SYSTEM_MESSAGE = """You are an expert prompt engineer. Your role is to generate clear, effective prompts based on user queries.
     
     IMPORTANT: Generate prompts ONLY. Do not engage in conversation or pleasantries.
     
@@ -62,18 +473,8 @@ prompt_generator = AssistantAgent(
     ### Generated Prompt:
     [Your prompt here]
     """
-)
 
-# Create prompt critic agent
-# Note: This agent only reviews and critiques prompt templates. It does NOT execute, validate, or run any queries
-# (such as SOQL queries). You will need to add your own examples and validation later.
-prompt_critic = AssistantAgent(
-    name="PromptCritic", 
-    llm_config={
-        "temperature": 0.3,
-        "config_list": [azure_config]
-    },
-    system_message="""You are an expert prompt critic. Your role is to analyze prompts and provide constructive feedback to improve them.
+CRITIC_SYSTEM_MESSAGE = """You are an expert prompt critic. Your role is to analyze prompts and provide constructive feedback to improve them.
     
     IMPORTANT: Focus ONLY on critiquing and improving the prompt. Do not engage in conversation or pleasantries.
     
@@ -93,128 +494,245 @@ prompt_critic = AssistantAgent(
     
     ### Final Approved Prompt:
     [The final, improved version of the prompt]
+    
+    ### End
     """
+
+# The critic ends every response with this line; it is passed as a stop sequence so the
+# response ends as soon as the final approved prompt is complete.
+CRITIC_END_MARKER = "### End"
+
+# Heading that precedes the approved prompt in the critic's response
+APPROVED_MARKER = "### Final Approved Prompt:"
+
+@dataclass(frozen=True)
+class Agent:
+    """A system message plus the sampling settings it is used with."""
+    name: str
+    system_message: str
+    temperature: float
+    stop: tuple = ()
+    max_tokens: Optional[int] = None
+
+# Completion caps. The critic rewrites the whole prompt, so its cap is the generator's cap
+# plus room for the critique and the suggested improvements.
+GENERATOR_MAX_TOKENS = 600
+CRITIQUE_TOKEN_BUDGET = 600
+CRITIC_MAX_TOKENS = GENERATOR_MAX_TOKENS + CRITIQUE_TOKEN_BUDGET
+
+# Create prompt generator agent
+# Note: This agent only generates prompt templates. It does NOT execute, validate, or run any queries
+# (such as SOQL queries). You will need to add your own examples and validation later.
+prompt_generator = Agent(
+    name="PromptGenerator",
+    system_message=GENERATOR_SYSTEM_MESSAGE,
+    temperature=0.7,
+    max_tokens=GENERATOR_MAX_TOKENS
 )
 
-# Create user proxy agent
-user_proxy = UserProxyAgent(
-    name="UserProxy",
-    human_input_mode="NEVER",
-    max_consecutive_auto_reply=2,
-    code_execution_config={"work_dir": "coding", "use_docker": False},
-    llm_config={
-        "temperature": 0.1,
-        "config_list": [azure_config]
-    }
+# Create prompt critic agent
+# Note: This agent only reviews and critiques prompt templates. It does NOT execute, validate, or run any queries
+# (such as SOQL queries). You will need to add your own examples and validation later.
+prompt_critic = Agent(
+    name="PromptCritic",
+    system_message=CRITIC_SYSTEM_MESSAGE,
+    temperature=0.0,
+    stop=(CRITIC_END_MARKER,),
+    max_tokens=CRITIC_MAX_TOKENS
 )
 
-def generate_and_refine_prompt(user_query: str, max_iterations: int = 4) -> str:
+# Static instruction at the start of every critique request; the prompt under review follows it
+CRITIQUE_HEADER = "Review and improve this prompt:"
+
+async def ask_agent(agent, message):
+    """Send a single message to an agent and return (reply, truncated)."""
+    messages = [
+        {"role": "system", "content": agent.system_message},
+        {"role": "user", "content": message}
+    ]
+    return await get_router().chat(messages, agent.temperature, agent.stop, agent.max_tokens)
+
+async def generate_draft(user_query, deterministic=False):
+    """Generate one prompt draft for the user's query."""
+    message = f"Generate a prompt for the following query: {user_query}"
+    generator = replace(prompt_generator, temperature=0.0) if deterministic else prompt_generator
+    draft, truncated = await retry_with_backoff(lambda: ask_agent(generator, message))
+    if truncated:
+        print(f"\nWarning: Generated prompt was cut off at {generator.max_tokens} tokens.")
+    return draft
+
+# The critic runs at temperature 0, so its review is a function of the prompt alone.
+# Keep the most recent reviews so identical prompts are only critiqued once.
+CRITIQUE_MEMO_SIZE = 512
+critique_memo = OrderedDict()
+
+async def critique_prompt(prompt):
+    """
+    Get the critic's review of a single prompt as (critique, truncated).
+    A truncated critique may end partway through the approved prompt.
     """
-    Generate and refine a prompt through sequential agent collaboration.
+    if prompt in critique_memo:
+        critique_memo.move_to_end(prompt)
+        return critique_memo[prompt]
+    result = await retry_with_backoff(lambda: ask_agent(prompt_critic, f"{CRITIQUE_HEADER}\n\n{prompt}"))
+    if result[0]:
+        critique_memo[prompt] = result
+        if len(critique_memo) > CRITIQUE_MEMO_SIZE:
+            critique_memo.popitem(last=False)
+    return result
+
+@dataclass
+class PromptResult:
+    """Outcome of generate_and_refine_prompt. Use format_report() for the printable version."""
+    initial: str
+    critiques: list = field(default_factory=list)
+    final: str = ""
+    error: Optional[str] = None
+
+    def format_report(self):
+        if self.error is not None:
+            return f"""
+Error occurred while generating prompt: {self.error}
+Please try again in 60 seconds if you hit the rate limit.
+"""
+        return f"""
+{'='*80}
+INITIAL GENERATED PROMPT:
+{'='*80}
+{self.initial}
+
+{'='*80}
+PROMPT CRITIC'S FEEDBACK:
+{'='*80}
+{chr(10).join(self.critiques)}
+
+{'='*80}
+FINAL APPROVED PROMPT:
+{'='*80}
+{self.final}
+{'='*80}
+"""
+
+async def generate_and_refine_prompt(user_query: str, use_cache: bool = True, num_drafts: int = 1,
+                                     deterministic: bool = False) -> PromptResult:
+    """
+    Generate and refine a prompt through agent collaboration: the generator writes each draft,
+    and the critic reviews every draft once and returns an improved, approved version.
     
     Note: This function only generates prompt templates. It does NOT execute, validate, or run any queries
     (such as SOQL queries). You will need to add your own examples and validation later.
     
     Args:
         user_query: The user's request for what kind of prompt to generate
-        max_iterations: Maximum number of iterations between generator and critic (default: 3)
+        use_cache: Return a previously generated result for the same query if one is cached.
+            Unless deterministic is set, the generator runs at temperature 0.7, so a cached
+            result is one sample, not the only answer.
+        num_drafts: Number of independent drafts to generate and critique concurrently (default: 1).
+            The first draft the critic approves is returned. More drafts cost more tokens but
+            make an approval more likely.
+        deterministic: Run the generator at temperature 0 as well, so the same query always
+            produces the same prompt (default: False)
     """
+    fingerprint = make_cache_fingerprint(num_drafts, deterministic)
+    cache_key = make_cache_key(user_query, fingerprint)
+    if use_cache:
+        try:
+            cached_output = get_response_cache().get(cache_key)
+            # Results are cached as plain dicts; skip anything written in another format
+            if isinstance(cached_output, dict):
+                print("\nReturning cached result for this query.")
+                return PromptResult(**cached_output)
+        except Exception as e:
+            # The caches are an optimisation; never fail the request because of them
+            print(f"\nResponse cache lookup failed: {str(e)}")
+
+    query_vector = None
+    semantic_cache = None
+    if use_cache:
+        try:
+            semantic_cache = get_semantic_cache()
+            if semantic_cache is not None:
+                query_vector = await semantic_cache.embed(user_query)
+                cached_output = semantic_cache.get(query_vector, fingerprint)
+                if isinstance(cached_output, dict):
+                    print("\nReturning cached result for a similar query.")
+                    return PromptResult(**cached_output)
+        except Exception as e:
+            query_vector = None
+            print(f"\nSemantic cache lookup failed: {str(e)}")
+
     try:
-        # Step 1: Generate initial prompt
+        # Step 1: Generate initial prompt drafts
         print("\nGenerating initial prompt...")
         
-        def generate_initial_prompt():
-            # Reset the chat for a clean start
-            user_proxy.reset()
-            user_proxy.initiate_chat(
-                prompt_generator,
-                message=f"Generate a prompt for the following query: {user_query}"
-            )
-            messages = user_proxy.chat_messages[prompt_generator]
-            return get_last_assistant_message(messages)
-        
-        generated_prompt = retry_with_backoff(generate_initial_prompt)
-        if not generated_prompt:
+        drafts = await asyncio.gather(*[generate_draft(user_query, deterministic) for _ in range(num_drafts)])
+        drafts = [draft for draft in drafts if draft]
+        if not drafts:
             raise Exception("Failed to get initial prompt from generator")
             
         print("\nInitial prompt generated. Getting critique...")
         
-        # Step 2: Get critique and improvements
+        # Step 2: Get one critique per draft, in parallel. The critic runs at temperature 0,
+        # so critiquing the same draft again would only return the same review.
+        critic_results = await asyncio.gather(*[critique_prompt(draft) for draft in drafts])
+        generated_prompt = drafts[0]
         current_prompt = generated_prompt
-        iteration = 0
-        all_critiques = []
+        all_critiques = [critic_results[0][0]] if critic_results[0][0] else []
+        was_approved = False
         
-        while iteration < max_iterations:
-            iteration += 1
-            print(f"\nIteration {iteration}/{max_iterations}: Getting critique...")
-            
-            critique_message = f"""Review and improve this prompt:
-
-{current_prompt}"""
-            
-            def get_critique():
-                try:
-                    # Reset the chat for a clean conversation with the critic
-                    user_proxy.reset()
-                    user_proxy.initiate_chat(
-                        prompt_critic,
-                        message=critique_message
-                    )
-                    messages = user_proxy.chat_messages[prompt_critic]
-                    return get_last_assistant_message(messages)
-                except Exception as e:
-                    if "Maximum number of consecutive auto-replies reached" in str(e):
-                        # If we hit the auto-reply limit, try to get the last message
-                        print("\nMaximum auto-replies reached. Attempting to extract final prompt...")
-                        try:
-                            messages = user_proxy.chat_messages[prompt_critic]
-                            if messages:
-                                return get_last_assistant_message(messages)
-                        except:
-                            pass
-                    raise e
-            
-            critic_response = retry_with_backoff(get_critique)
+        if not any(critique for critique, _ in critic_results):
+            print("\nWarning: No response from critic")
+        
+        for draft, (critic_response, truncated) in zip(drafts, critic_results):
             if not critic_response:
-                print(f"\nWarning: No response from critic in iteration {iteration}")
-                break
-                
-            all_critiques.append(critic_response)
-            
-            # Extract the final approved prompt from the critic's response
-            if "### Final Approved Prompt:" in critic_response:
-                current_prompt = critic_response.split("### Final Approved Prompt:")[1].strip()
-                print(f"Iteration {iteration}: Prompt approved by critic.")
+                continue
+            # Extract the final approved prompt from the first approving critique
+            _, marker, approved_prompt = critic_response.partition(APPROVED_MARKER)
+            if marker and truncated:
+                # The approved prompt may be cut off mid-way; don't return or cache it
+                print(f"\nWarning: Critique was cut off at {prompt_critic.max_tokens} tokens; "
+                      "not treating it as approved.")
+            elif marker:
+                generated_prompt = draft
+                current_prompt = approved_prompt.strip()
+                all_critiques = [critic_response]
+                was_approved = True
+                print("Prompt approved by critic.")
                 break
-            else:
-                print(f"Iteration {iteration}: Prompt needs improvement. Continuing to next iteration...")
+        else:
+            print("Critic did not approve any draft.")
         
-        # Format the complete output
-        complete_output = f"""
-{'='*80}
-INITIAL GENERATED PROMPT:
-{'='*80}
-{generated_prompt}
-
-{'='*80}
-PROMPT CRITIC'S FEEDBACK:
-{'='*80}
-{chr(10).join(all_critiques)}
-
-{'='*80}
-FINAL APPROVED PROMPT:
-{'='*80}
-{current_prompt}
-{'='*80}
-"""
-        return complete_output
+        result = PromptResult(generated_prompt, all_critiques, current_prompt)
         
     except Exception as e:
-        error_message = f"""
-Error occurred while generating prompt: {str(e)}
-Please try again in 60 seconds if you hit the rate limit.
-"""
-        return error_message
+        return PromptResult("", error=str(e))
+
+    # Only cache results the critic actually approved; anything else is worth retrying.
+    # A failed cache write must not throw away a successful generation.
+    if was_approved:
+        try:
+            get_response_cache().set(cache_key, asdict(result))
+            if query_vector is not None:
+                semantic_cache.add(query_vector, user_query, fingerprint, asdict(result))
+        except Exception as e:
+            print(f"\nFailed to cache result: {str(e)}")
+    return result
+
+async def generate_batch(queries, concurrency: int = 8, **kwargs) -> list:
+    """
+    Run generate_and_refine_prompt over many queries with at most `concurrency` running at once.
+    Extra keyword arguments are passed through to generate_and_refine_prompt.
+    Results are returned in the same order as the queries.
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(query):
+        async with semaphore:
+            return await generate_and_refine_prompt(query, **kwargs)
+
+    return await asyncio.gather(*[run_one(query) for query in queries])
 
 # Example usage:
 if __name__ == "__main__":
@@ -224,5 +742,5 @@ if __name__ == "__main__":
     print("\nStarting prompt generation process...")
     print("This may take a few moments...\n")
     
-    refined_prompt = generate_and_refine_prompt(user_query)
-    print(refined_prompt)
+    result = asyncio.run(generate_and_refine_prompt(user_query))
+    print(result.format_report())